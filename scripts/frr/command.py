@@ -5,7 +5,7 @@
 from re import sub, findall, split, match
 from string import Formatter
 import operator
-import ast
+import json
 
 MISSING_VALUE_TEMPLATE = '???'
 OPERATOR_EXPRESSION = r"(==|>=|<=|>|<|!=| in |\s)"
@@ -16,22 +16,38 @@ class CommandFiller:
     and filling them with their values that are passed as parameters.
     """
     PATTERN_REGEX = r'\[[^]]+\]'
+    # path references of each template, shared by all fillers
+    _refs_cache = {}
 
     def __init__(self, command, debug=False):
+        self.template = command
         self.command = command
         self.debug = debug
         self.formatter = CommandFormatter(self.debug)
+        # generated by compile()
+        self._fill_values = None
 
     def find_all_path_refs(self):
-        """Finds all path references to other tree nodes that exist in the command
-        @return: list of paths
+        """Finds all path references to other tree nodes that exist in the command.
+        The template is only parsed the first time it is seen.
+        @return: tuple of paths
         """
-        return self.formatter.find_all_path_refs(self.command)
+        refs = CommandFiller._refs_cache.get(self.template)
+        if refs is None:
+            refs = tuple(self.formatter.find_all_path_refs(self.template))
+            CommandFiller._refs_cache[self.template] = refs
+        return refs
 
     def fill_command(self, values):
-        """Treats all patterns in the raw command string"""
+        """Treats all patterns in the raw command string.
+        Always starts from the template so the filler can be reused.
+        """
         # print(self.command, values)
-        self.command = self.fill_values(values)
+        self.command = self.template
+        if self._fill_values is not None:
+            self.command = self._fill_values(values)
+        else:
+            self.command = self.fill_values(values)
         self.execute_functions()
         self.finalize_sets()
         if MISSING_VALUE_TEMPLATE in self.command:
@@ -41,6 +57,53 @@ class CommandFiller:
             self.remove_extra_whitespaces()
         return self.command
 
+    def compile(self):
+        """Generates a function which fills the references of the template
+        like fill_values(), without parsing the template on every call.
+        Each reference becomes a lookup in the values dict, joined with the
+        literal text around it.
+        Templates using nested or positional fields, and debugging (which
+        reports missing values), are left to the formatter.
+        @return: True if the template was compiled
+        """
+        if self.debug:
+            return False
+        try:
+            parsed = list(self.formatter.parse(self.template))
+        except ValueError:
+            # malformed template, let fill_values() report it
+            return False
+
+        parts = []
+        for literal, field_name, format_spec, conversion in parsed:
+            if literal:
+                parts.append(repr(literal))
+            if field_name is None:
+                continue
+            if (field_name == '' or field_name.isdigit() or '.' in field_name
+                    or '[' in field_name or '{' in format_spec):
+                return False
+            part = 'get({!r}, MISSING)'.format(field_name)
+            if conversion:
+                part = 'convert_field({}, {!r})'.format(part, conversion)
+            if format_spec:
+                part = 'format_field({}, {!r})'.format(part, format_spec)
+            else:
+                part = 'format({}, "")'.format(part)
+            parts.append(part)
+
+        source = ('def fill_values(values):\n'
+                  '    get = values.get\n'
+                  '    return "".join([{}])\n').format(', '.join(parts))
+        namespace = {
+            'MISSING': MISSING_VALUE_TEMPLATE,
+            'convert_field': self.formatter.convert_field,
+            'format_field': self.formatter.format_field,
+        }
+        exec(source, namespace)
+        self._fill_values = namespace['fill_values']
+        return True
+
     @staticmethod
     def execute_code(code):
         """Evaluate the python code given as string.
@@ -77,15 +140,15 @@ class CommandFiller:
 
     @staticmethod
     def exists_in(k, json_dict):
-        """Wrapper function for a key test of a dictionary.
-        Uses the ast.literal_eval as it works only on a reduced set of python
-        code.
+        """Wrapper function for a key test of a dictionary."""
+        return k in CommandFiller.decode_dict(json_dict)
 
-        It's possible that extremely large dictionaries will crash the python
-        interpreter.
+    @staticmethod
+    def decode_dict(json_dict):
+        """Decodes the json of a node referenced with @dict. Its members are
+        separated by "&" instead of ",", as the if conditional code splits on ",".
         """
-        json_dict = json_dict.replace("&", ",")
-        return k in ast.literal_eval(json_dict)
+        return json.loads(json_dict.replace("&", ","))
 
     @staticmethod
     def set_else(zipped_list):
@@ -158,7 +221,7 @@ class CommandFiller:
         This function will take each element of the /policy/route/access-list
         list and generate multiple lines of config for the access-list
         """
-        json_dict = ast.literal_eval(acl_dict.replace("&", ","))
+        json_dict = CommandFiller.decode_dict(acl_dict)
         result = ""
 
         prefix_string = "access-list {0}".format(json_dict["tagnode"])
@@ -32,6 +32,12 @@ class CommandFillerTestCase(unittest.TestCase):
         actual = list(command.find_all_path_refs())
         self.assertCountEqual(expected, actual)
 
+    def test_find_patterns_cached(self):
+        template = 'abc {/name/@text} ef {/../surname/@text}'
+        refs = CommandFiller(template).find_all_path_refs()
+        self.assertEqual(('/name/@text', '/../surname/@text'), refs)
+        self.assertIs(refs, CommandFiller(template).find_all_path_refs())
+
     def test_fill_simple(self):
         command = CommandFiller('abc {/name/@text} ef')
         inputValues = dict([('/name/@text', 'Mix')])
@@ -90,6 +96,16 @@ class CommandFillerTestCase(unittest.TestCase):
         expected = 'ef age 20'
         self.assertEqual(expected, actual)
 
+    def test_fill_command_reused(self):
+        command = CommandFiller('ef [name {/names/@text}, age {/age/@text}]')
+        actual = command.fill_command(dict([('/names/@text', 'theo')]))
+        expected = 'ef name theo'
+        self.assertEqual(expected, actual)
+
+        actual = command.fill_command(dict([('/age/@text', '20')]))
+        expected = 'ef age 20'
+        self.assertEqual(expected, actual)
+
     def test_unfilled_optionals_removed(self):
         command = CommandFiller('ef [name {/names/@text},] and [{/age/@text}]')
         inputValues = dict([('/age/@text', '20')])
@@ -254,16 +270,54 @@ class CommandFillerTestCase(unittest.TestCase):
 
     def test_conditional_key_in_dictionary(self):
         conditional = ['if', 'age 21,name mm',
-                       "test in {'notest':2&'test':1},"]
+                       'test in {"notest":2&"test":1},']
         actual = CommandFiller.execute_conditional(conditional)
         expected = 'age 21'
         self.assertEqual(expected, actual)
 
-        conditional = ['if', 'age 21,name mm', "result in {'test':1},"]
+        conditional = ['if', 'age 21,name mm', 'result in {"test":1},']
         actual = CommandFiller.execute_conditional(conditional)
         expected = 'name mm'
         self.assertEqual(expected, actual)
 
+    def test_conditional_key_in_dictionary_null(self):
+        conditional = ['if', 'age 21,name mm', 'test in {"notest":2&"test":null},']
+        actual = CommandFiller.execute_conditional(conditional)
+        expected = 'age 21'
+        self.assertEqual(expected, actual)
+
+    def test_acl(self):
+        acl = ('{"tagnode":"10"&"rule":[{"tagnode":"1"&"action":"permit"&'
+               '"source":{"any":null}}&{"tagnode":"2"&"action":"deny"&'
+               '"source":{"host":"10.0.0.1"}}]}')
+        actual = CommandFiller.execute_acl(acl)
+        expected = ('access-list 10 seq 1 permit any\n'
+                    'access-list 10 seq 2 deny host 10.0.0.1')
+        self.assertEqual(expected, actual)
+
+    def test_compiled_fill(self):
+        template = 'ef {/name/@text} [age {/age/@text},] {{x}} {/l/@text!r} {/n/@text:+04}'
+        inputValues = dict([('/name/@text', 'theo'), ('/l/@text', 'mm'), ('/n/@text', 5)])
+        expected = CommandFiller(template).fill_command(inputValues)
+        command = CommandFiller(template)
+        self.assertTrue(command.compile())
+        actual = command.fill_command(inputValues)
+        self.assertEqual(expected, actual)
+        self.assertEqual("ef theo {x} 'mm' +005", actual)
+
+        inputValues['/age/@text'] = 20
+        actual = command.fill_command(inputValues)
+        self.assertEqual("ef theo age 20 {x} 'mm' +005", actual)
+
+    def test_compile_falls_back(self):
+        command = CommandFiller('ef {/name/@text:for:{{element}} }')
+        self.assertFalse(command.compile())
+        actual = command.fill_command(dict([('/name/@text', ['a', 'b'])]))
+        self.assertEqual("ef a b ", actual)
+
+        self.assertFalse(CommandFiller('ef {0}').compile())
+        self.assertFalse(CommandFiller('ef {/name/@text}', debug=True).compile())
+
     def test_None_value_parsed(self):
         command = CommandFiller('ef {/name/@text}')
         inputValues = dict([('/name/@text', None)])
@@ -4,24 +4,35 @@
 # SPDX-License-Identifier: GPL-2.0-only
 
 from argparse import ArgumentParser
-from collections import OrderedDict
+from collections import namedtuple
+import io
 import json
 import os
-from os import listdir
 import shutil
 import subprocess
 import sys
+import tempfile
 
-from vyatta.command import CommandFiller, MISSING_VALUE_TEMPLATE
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
+from vyatta.command import CommandFiller
 
 TEXT_LEAF_LABEL = '@text'
 LIST_ELEM_LABEL = '@element'
 DICT_ELEM_LABEL = '@dict'
 ENTER_LABEL = '@enter'
 EXIT_LABEL = '@exit'
+_ENTER_SUFFIX = '/' + ENTER_LABEL
+_EXIT_SUFFIX = '/' + EXIT_LABEL
 
 DIR_TRAVERSE_UP_LABEL = "¬"
 
+# returned by retrieve_value when the referenced node doesn't exist
+_MISSING = object()
+
 CONFIGS_DIR = '/etc/vyatta-routing/configs'
 PRIORITIES_FILENAME = '/priorities.json'
 STEPS_FILENAME = '/steps.json'
@@ -35,6 +46,36 @@ FRR_RELOAD = "/usr/bin/vtysh"
 def print_err(x): return print(x, file=sys.stderr)
 
 
+# a command template along with the path references it contains
+PreparsedCommand = namedtuple('PreparsedCommand', ['filler', 'refs'])
+
+
+def preparse_command(command, debug=False):
+    """Creates and compiles the CommandFiller of a command and finds its references"""
+    # make references valid identifier names to allow them to be treated by string formatter
+    commandf = CommandFiller(
+        command.replace('..', DIR_TRAVERSE_UP_LABEL), debug)
+    commandf.compile()
+    # resolve repeated references, eg. several {/@dict}, only once
+    return PreparsedCommand(
+        commandf, tuple(dict.fromkeys(commandf.find_all_path_refs())))
+
+
+def preparse_syntax(syntax, debug=False):
+    """Parses the command(s) of every path in a syntax dict, so the
+    templates are parsed once instead of on every node visit.
+    Returns a dict of path to list of PreparsedCommand.
+    """
+    preparsed = {}
+    for path, commands in syntax.items():
+        if isinstance(commands, str):
+            commands = [commands]
+        # interned like the traversal paths, so lookups compare identities
+        preparsed[sys.intern(path)] = [
+            preparse_command(command, debug) for command in commands]
+    return preparsed
+
+
 class VyattaJSONParser:
     """Traverses the json config, visits every node and extracts the values of
     keys referenced in the commands
@@ -65,7 +106,7 @@ class VyattaJSONParser:
             syntax = {}
             for syntax_file in self._translations:
                 if not syntax_file.processed:
-                    syntax = {**syntax, **syntax_file.load()}
+                    syntax.update(syntax_file.load(parser.debug))
                     syntax_file.processed = True
 
             parser.syntax = syntax
@@ -80,49 +121,85 @@ class VyattaJSONParser:
             self._path = path
             self._name = name
 
-        def load(self):
-            with open(os.path.join(self._path, self._name), 'r') as syntax_json:
-                return json.load(syntax_json)
+        def load(self, debug=False):
+            """Returns the syntax of the file with its commands preparsed"""
+            with open(os.path.join(self._path, self._name), 'rb') as syntax_json:
+                return preparse_syntax(json_loads(syntax_json.read()), debug)
+
+
+    class OutputWriter:
+        """
+        Writes the CLI commands to the output file as they are produced,
+        instead of holding the whole configuration in memory.
+
+        Provides the list methods the parser uses on its output.
+        """
+
+        BUFFER_SIZE = 1 << 20
 
+        def __init__(self, fd, debug=False):
+            self._file = io.BufferedWriter(io.FileIO(fd, 'w'), self.BUFFER_SIZE)
+            self._debug = debug
+
+        def append(self, line):
+            if self._debug:
+                print(line)
+            self._file.write((line + '\n').encode())
+
+        def extend(self, lines):
+            for line in lines:
+                self.append(line)
+
+        def close(self):
+            self._file.close()
+
+
+    # steps of each reference path, shared as references are syntax constants
+    _steps_cache = {}
 
     def __init__(self, vyatta_config=None, syntax=None, debug=False):
         self.tree = vyatta_config
-        self.syntax = {} if syntax is None else syntax
+        self.syntax = {} if syntax is None else preparse_syntax(syntax, debug)
         self.syntax_files = {}
         self.steps = []
         # holds the parent of each node in the json. Used to traverse up the tree
         self.parent_stack = []
-        # holds the CLI commands as a list of strings
+        # holds the path of each child by (parent path, key), see depth_first_traverse()
+        self._child_paths = {}
+        # holds the CLI commands as a list of strings, or an OutputWriter
+        # when the commands are streamed to the output file
         self.output = []
         # enables debugging commands
         self.debug = debug
+        # paths of the nodes with enter / exit commands in the syntax
+        self._find_enter_exit_paths()
 
     def read_vyatta_config(self, path):
         """Reads vyatta json config file"""
-        with open(path, 'r') as vyatta_json:
+        with open(path, 'rb') as vyatta_json:
             self.tree = self.decode_vyatta_config(vyatta_json.read())
 
     def decode_vyatta_config(self, config_string):
-        """Decodes the json with OrderedDicts instead of dicts"""
-        return json.loads(config_string, object_pairs_hook=OrderedDict)
+        """Decodes the json, relying on dicts preserving insertion order"""
+        return json_loads(config_string)
 
     def discover_syntax(self, dir):
-        command_files = filter(
-            lambda x: x.lower().endswith('.json'), listdir(dir))
-        self.syntax_files = dict(
-            [(x, self.SyntaxFile(dir, x)) for x in command_files])
+        with os.scandir(dir) as entries:
+            self.syntax_files = {
+                entry.name: self.SyntaxFile(dir, entry.name) for entry in entries
+                if entry.name.lower().endswith('.json') and entry.is_file()}
 
     def read_syntax_files(self, dir_path):
         """Reads all files syntax files and merges them to one big
         dict with all the syntax commands"""
         self.syntax = {}
         self.discover_syntax(dir_path)
-        for syntax_file in self.syntax_files:
-            self.syntax = {**self.syntax, **syntax_file.load()}
+        for syntax_file in self.syntax_files.values():
+            self.syntax.update(syntax_file.load(self.debug))
 
     def load_steps(self, path):
-        with open(path, 'r') as f:
-            steps = json.load(f)
+        with open(path, 'rb') as f:
+            steps = json_loads(f.read())
 
         for step in steps:
             syntax = step.get("translate", [])
@@ -136,26 +213,80 @@ class VyattaJSONParser:
                 syntax = [self.syntax_files[f] for f in syntax]
             self.steps.append(self.Step(step.get("config", []), syntax))
 
-    def execute_steps(self):
-        for step in self.steps:
-            self.parent_stack = []
-            self.syntax = {}
-            step.execute(self)
+    def execute_steps(self, path=None):
+        """Executes the parsing steps. If path is given the output is
+        written to a temporary file next to it while the steps are executed,
+        output_config() then moves it onto path.
+        """
+        if path is not None:
+            try:
+                self.open_output(path)
+            except Exception:
+                # keep the output in memory, output_config() reports the failure
+                pass
+        try:
+            for step in self.steps:
+                self.parent_stack = []
+                self.syntax = {}
+                step.execute(self)
+        except BaseException:
+            # leave the existing config file alone
+            self.discard_output()
+            raise
+
+    @staticmethod
+    def _open_output_file(path):
+        # fds are already non-inheritable (PEP 446), O_CLOEXEC only makes
+        # that explicit for the FRR reload subprocess
+        fd = os.open(path, os.O_CREAT | os.O_TRUNC | os.O_WRONLY | os.O_CLOEXEC,
+                     0o600)
+        try:
+            # Ensure permissions are set on an existing file
+            os.fchmod(fd, 0o600)
+        except Exception:
+            os.close(fd)
+            raise
+        return fd
+
+    def open_output(self, path):
+        """Streams the output to a temporary file in the directory of path
+        from now on. The file is created with 0600 permissions.
+        """
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.',
+                                        prefix=os.path.basename(path) + '.')
+        writer = self.OutputWriter(fd, self.debug)
+        self._output_tmp_path = tmp_path
+        writer.extend(self.output)
+        self.output = writer
+
+    def discard_output(self):
+        """Closes and removes the temporary file the output is streamed to"""
+        if not isinstance(self.output, self.OutputWriter):
+            return
+        writer, self.output = self.output, []
+        try:
+            writer.close()
+        except Exception:
+            pass
+        try:
+            os.unlink(self._output_tmp_path)
+        except OSError:
+            pass
 
     def output_config(self, path, owner):
-        """Write the already parsed config to a file"""
+        """Write the already parsed config to a file, or finish writing it
+        if it was streamed to a temporary file while parsing and replace
+        the file with it
+        """
         # avoid empty file
         self.output.append('!')
-        config = '\n'.join(self.output)
-        if self.debug:
-            print(config)
+        if isinstance(self.output, self.OutputWriter):
+            # the temporary file is next to path, so replacing it is atomic
+            self._finish_output(path, owner)
+            return
 
         try:
-            fd = os.open(path, os.O_CREAT | os.O_TRUNC | os.O_WRONLY)
-            # Ensure permissions are set on an existing file
-            os.fchmod(fd, 0o600)
-            with os.fdopen(fd, 'w') as write_file:
-                write_file.write(config)
+            self._write_config(path)
         except Exception as e:
             print_err("Failed to write configuration: {}".format(e))
             return
@@ -165,101 +296,195 @@ class VyattaJSONParser:
         except Exception as e:
             print_err("Failed to set configuration file owner: {}".format(e))
 
+    def _finish_output(self, path, owner):
+        tmp_path = self._output_tmp_path
+        try:
+            self.output.close()
+        except Exception as e:
+            self.discard_output()
+            print_err("Failed to write configuration: {}".format(e))
+            return
+
+        try:
+            shutil.chown(tmp_path, owner, owner)
+        except Exception as e:
+            print_err("Failed to set configuration file owner: {}".format(e))
+
+        try:
+            os.replace(tmp_path, path)
+        except Exception as e:
+            self.discard_output()
+            print_err("Failed to write configuration: {}".format(e))
+
+    def _write_config(self, path):
+        lines = [line.encode() for line in self.output]
+        # preallocate the whole config, one newline per line
+        config = bytearray(sum(map(len, lines)) + len(lines))
+        view = memoryview(config)
+        offset = 0
+        for line in lines:
+            end = offset + len(line)
+            view[offset:end] = line
+            view[end] = 0x0A  # '\n'
+            offset = end + 1
+        if self.debug:
+            print(config.decode(), end='')
+
+        fd = self._open_output_file(path)
+        try:
+            self._write_all(fd, config)
+        finally:
+            os.close(fd)
+
+    @staticmethod
+    def _write_all(fd, data):
+        """Writes data to the raw fd, retrying on short writes"""
+        view = memoryview(data)
+        while view:
+            view = view[os.write(fd, view):]
+
     def prioritize(self, filepath):
         """Reads priorities file and sorts the configuration tree"""
-        with open(filepath, 'r') as priorities_json:
-            priorities = json.load(priorities_json)
+        with open(filepath, 'rb') as priorities_json:
+            priorities = json_loads(priorities_json.read())
         self.sort_tree(priorities)
 
     def sort_tree(self, priorities):
         """Sorts the vyatta config according to the priorities dict"""
-        for node, path in self.depth_first_traverse(self.tree):
-            defined_priorities = priorities.get(path, {})
-            first_keys = defined_priorities.get('first', [])
-            last_keys = defined_priorities.get('last', [])
-            # reverse first to sort keys the same way as defined in first list
-            for key in reversed(first_keys):
-                if key in node:
-                    node.move_to_end(key, False)
-            for key in last_keys:
-                if key in node:
-                    node.move_to_end(key, True)
-        # clear commands triggering from traversing the tree
-        self.output.clear()
+        self._sort_traverse(self.tree, priorities)
+
+    @staticmethod
+    def _sort_traverse(tree, priorities):
+        """Visits every dict and list of the tree and reorders the dict keys.
+        Unlike depth_first_traverse no commands are processed and the leaves
+        are skipped.
+        """
+        stack = [(tree, '')]
+        while stack:
+            node, path = stack.pop()
+            if isinstance(node, dict):
+                defined_priorities = priorities.get(path or '/')
+                if defined_priorities is not None:
+                    VyattaJSONParser._sort_keys(node, defined_priorities)
+                stack.extend((child, path + '/' + key) for key, child in node.items()
+                             if isinstance(child, (dict, list)))
+            elif isinstance(node, list):
+                child_path = path + '/' + LIST_ELEM_LABEL
+                stack.extend((elem, child_path) for elem in node
+                             if isinstance(elem, (dict, list)))
+
+    @staticmethod
+    def _sort_keys(node, defined_priorities):
+        first_keys = [key for key in dict.fromkeys(
+            defined_priorities.get('first', [])) if key in node]
+        last_keys = defined_priorities.get('last', [])
+        if first_keys:
+            # dicts can only append, so reinsert every key with the
+            # first keys at the front, in the order of the first list
+            for key in first_keys + [k for k in node if k not in first_keys]:
+                node[key] = node.pop(key)
+        for key in last_keys:
+            if key in node:
+                node[key] = node.pop(key)
 
     def _process_commands(self, node, path):
-        for command in self.retrieve_commands(path):
+        # hot path, bind the methods to locals
+        retrieve_values = self.retrieve_values
+        append = self.output.append
+        for commandf, pattern_refs in self.retrieve_commands(path):
             # command template exists for this node
-            commandf = CommandFiller(command, self.debug)
-            pattern_values = commandf.find_all_path_refs()
-            # print(command, pattern_values)
-            pattern_values = self.retrieve_values(node, pattern_values)
+            pattern_values = retrieve_values(node, pattern_refs)
             command = commandf.fill_command(pattern_values)
             if command != '':
-                self.output.append(command)
+                append(command)
 
     def parse_config(self):
         """Retrieves each node's command and puts it in the output CLI config
-        Returns list of command strings.
+        Returns the output, a list of command strings or the OutputWriter
+        when the commands are streamed to the output file.
         """
+        self._find_enter_exit_paths()
+        # hot path, bind the attributes and methods to locals
+        syntax = self.syntax
+        enter_paths = self._enter_paths
+        on_enter = self.on_enter
+        process_commands = self._process_commands
         for node, path in self.depth_first_traverse(self.tree):
-            self.on_enter(node, path)
-            self._process_commands(node, path)
+            # most nodes are leaves without any commands
+            if path in enter_paths:
+                on_enter(node, path)
+            if path in syntax:
+                process_commands(node, path)
         return self.output
 
+    def _find_enter_exit_paths(self):
+        """Finds the node paths which have enter or exit commands in the syntax"""
+        self._enter_paths = {path[:-len(_ENTER_SUFFIX)] for path in self.syntax
+                             if path.endswith(_ENTER_SUFFIX)}
+        self._exit_paths = {path[:-len(_EXIT_SUFFIX)] for path in self.syntax
+                            if path.endswith(_EXIT_SUFFIX)}
+
     def retrieve_commands(self, path):
-        """Retrieves the command(s) associated with this path, if any"""
-        commands = self.syntax.get(path, [])
-        if isinstance(commands, str):
-            commands = [commands]
-        # make references valid identifier names to allow them to be treated by string formatter
-        return map(lambda x: x.replace('..', DIR_TRAVERSE_UP_LABEL), commands)
+        """Retrieves the preparsed command(s) associated with this path, if any"""
+        return self.syntax.get(path, [])
 
     def depth_first_traverse(self, node, path=''):
         """Traverses the tree in a DFS style returning every node and its path.
-        Stores the parent in the stack at each level of recursion and pops it out when done.
+        Stores the parent in the stack at each level of depth and pops it out when done.
         Creates the path of each node incrementally.
+        Uses an explicit stack of (node, path, exiting) entries instead of recursion:
+        once a node is returned, an exit entry for it is pushed followed by its
+        children in reverse order, so the children are visited in order first.
+        The paths are cached and interned, as they repeat across list elements
+        and match the (interned) syntax paths.
         """
-        if path == '':
-            yield(node, '/')
-        else:
-            yield(node, path)
-        self.parent_stack.append(node)
-        if isinstance(node, dict):
-            for key in node:
-                child_path = path+'/' + key
-                yield from self.depth_first_traverse(node[key], child_path)
-        elif isinstance(node, list):
-            for elem in node:
-                child_path = path+'/' + LIST_ELEM_LABEL
-                yield from self.depth_first_traverse(elem, child_path)
-        self.on_exit(node, path)
-        self.parent_stack.pop()
+        # hot path, bind the attributes and methods to locals
+        child_paths = self._child_paths
+        get_child_path = child_paths.get
+        parent_stack = self.parent_stack
+        on_exit = self.on_exit
+        stack = [(node, path, False)]
+        pop = stack.pop
+        push = stack.append
+        extend = stack.extend
+        while stack:
+            node, path, exiting = pop()
+            if exiting:
+                on_exit(node, path)
+                parent_stack.pop()
+                continue
+
+            yield(node, path or '/')
+            parent_stack.append(node)
+            push((node, path, True))
+            if isinstance(node, dict):
+                children = []
+                for key, child in node.items():
+                    child_path = get_child_path((path, key))
+                    if child_path is None:
+                        child_path = sys.intern(f'{path}/{key}')
+                        child_paths[(path, key)] = child_path
+                    children.append((child, child_path, False))
+                extend(reversed(children))
+            elif isinstance(node, list):
+                child_path = get_child_path((path, LIST_ELEM_LABEL))
+                if child_path is None:
+                    child_path = sys.intern(f'{path}/{LIST_ELEM_LABEL}')
+                    child_paths[(path, LIST_ELEM_LABEL)] = child_path
+                extend((elem, child_path, False) for elem in reversed(node))
 
     def on_enter(self, node, path):
         """Executed when node is just visited.
         Used for enter commands.
         """
-        self._process_commands(node, path+'/'+ENTER_LABEL)
+        self._process_commands(node, path + _ENTER_SUFFIX)
 
     def on_exit(self, node, path):
         """Executed when we visited node in path and all its children.
         Removes node from the parent stack and checks if there are any exit commands.
         """
-        self._process_commands(node, path+'/'+EXIT_LABEL)
-
-    def find_origin_node(self, node, target_steps):
-        """Traverses up the tree as many levels as indicated by the steps list,
-        removing the backward steps on the way
-        """
-        levels_up = 0
-        while target_steps[0] == DIR_TRAVERSE_UP_LABEL:
-            # print(node, targetSteps)
-            target_steps.pop(0)
-            levels_up += 1
-            node = self.parent_stack[-levels_up]
-
-        return node
+        if path in self._exit_paths:
+            self._process_commands(node, path + _EXIT_SUFFIX)
 
     def retrieve_values(self, node, paths):
         """Retrieves the values of nodes referenced in paths (if they exist).
@@ -272,69 +497,53 @@ class VyattaJSONParser:
         # print(node, paths)
         values = {}
         for path in paths:
-            steps_to_value = [
-                step for step in path.split('/') if not step == '']
+            steps_to_value = self._steps_cache.get(path)
+            if steps_to_value is None:
+                steps_to_value = tuple(
+                    step for step in path.split('/') if not step == '')
+                self._steps_cache[path] = steps_to_value
             value = self.retrieve_value(node, steps_to_value)
-            if value != MISSING_VALUE_TEMPLATE:
+            if value is not _MISSING:
                 values[path] = value
         return values
 
-    def recursive_dictionary_swap(self, node):
-        """
-        The dictionaries can contain dictionaries and previously only the top
-        level ordered dictionary was cast to a dictionary. This function
-        recursively casts ordered dictionaries into the dictionary type
-        """
-        for key in node:
-            if type(node[key]) is list:
-                if type(node[key][0]) is OrderedDict:
-                    new_list = []
-                    for entry in node[key]:
-                        new_list.append(
-                            self.recursive_dictionary_swap(dict(entry)))
-                    node[key] = new_list
-            elif type(node[key]) is OrderedDict:
-                node[key] = self.recursive_dictionary_swap(dict(node[key]))
-        return node
-
-    def retrieve_value(self, node, target_steps):
+    def retrieve_value(self, node, target_steps, i=0):
         """Retrieves the value of a node referenced by target steps (if exists)
 
         @param node: the origin node where the relative path starts in
-        @param target_steps: the relative path as a list of steps
-        @return: value or None if referenced node doesn't exist
+        @param target_steps: the relative path as a sequence of steps
+        @param i: the index of the first step to follow
+        @return: value or _MISSING if referenced node doesn't exist
         """
         # print(node, target_steps)
-        node = self.find_origin_node(node, target_steps)
-        step = target_steps.pop(0)
-        value = MISSING_VALUE_TEMPLATE
-        if step == TEXT_LEAF_LABEL:
-            if type(node) in [OrderedDict, list] and self.debug:
-                print('Warning:', node, 'is not a leaf')
-            # extract text value
-            value = node
-        elif step == DICT_ELEM_LABEL:
-            if type(node) is list:
-                new_list = []
-                for elem in list(node):
-                    if type(elem) is OrderedDict:
-                        elem = self.recursive_dictionary_swap(dict(elem))
-                    new_list.append(elem)
-                node = new_list
-            if type(node) is OrderedDict:
-                node = self.recursive_dictionary_swap(dict(node))
-            # When using dictionaries we need to replace ", " with another
-            # symbol as the if conditional code splits on "," which breaks
-            # dictionaries.
-            value = str(node).replace(", ", "&")
-            value = str(value).replace(" ", "")
-        else:
+        while True:
+            # traverse up the tree as many levels as the backward steps
+            levels_up = 0
+            while target_steps[i] == DIR_TRAVERSE_UP_LABEL:
+                i += 1
+                levels_up += 1
+                node = self.parent_stack[-levels_up]
+
+            step = target_steps[i]
+            if step == TEXT_LEAF_LABEL:
+                if isinstance(node, (dict, list)) and self.debug:
+                    print('Warning:', node, 'is not a leaf')
+                # extract text value
+                return node
+            if step == DICT_ELEM_LABEL:
+                # When using dictionaries we need to separate the members with
+                # another symbol as the if conditional code splits on "," which
+                # breaks dictionaries, and on whitespace. Only the separators
+                # are followed by a space, so commas inside values are kept.
+                return json.dumps(node, ensure_ascii=False).replace(
+                    ", ", "&").replace(" ", "")
             try:
-                value = self.retrieve_value(node[step], target_steps)
+                node = node[step]
             except (KeyError, TypeError) as _:
                 if self.debug:
                     print('Warning: Couldnt find', step, 'in', node)
-        return value
+                return _MISSING
+            i += 1
 
 
 def main():
@@ -357,7 +566,7 @@ def main():
     v.prioritize(args.c + PRIORITIES_FILENAME)
     v.discover_syntax(args.c + COMMANDS_DIRNAME)
     v.load_steps(args.c + STEPS_FILENAME)
-    v.execute_steps()
+    v.execute_steps(args.o)
     v.output_config(args.o, OUTPUT_FILE_OWNER)
 
     if args.reload:
@@ -3,7 +3,11 @@
 #
 # SPDX-License-Identifier: GPL-2.0-only
 
-from parser import VyattaJSONParser, TEXT_LEAF_LABEL, OrderedDict, DIR_TRAVERSE_UP_LABEL, DICT_ELEM_LABEL
+from parser import VyattaJSONParser, PreparsedCommand, TEXT_LEAF_LABEL, DIR_TRAVERSE_UP_LABEL, DICT_ELEM_LABEL
+import getpass
+import json
+import os
+import tempfile
 import unittest
 
 
@@ -34,31 +38,47 @@ class ParserTestCase(unittest.TestCase):
         expected = None
         self.assertEqual(actual, expected)
 
-    def test_obj_decode_as_OrderedDict(self):
+    def test_obj_decode_as_dict(self):
         v = VyattaJSONParser({}, {})
         node = '{"protocols": null}'
         actual = type(v.decode_vyatta_config(node))
-        expected = type(OrderedDict())
+        expected = dict
         self.assertEqual(actual, expected)
 
-    def test_retreive_multi_OrderedDict(self):
+    def test_retreive_multi_dict(self):
         v = VyattaJSONParser({}, {})
-        node = OrderedDict(
-            [('protocols', OrderedDict([('ospf', OrderedDict([('timers', 'timerVal')]))]))])
+        node = {'protocols': {'ospf': {'timers': 'timerVal'}}}
         steps = ['protocols', DICT_ELEM_LABEL]
         actual = v.retrieve_value(node, steps)
         print(actual)
-        expected = "{'ospf':{'timers':'timerVal'}}"
+        expected = '{"ospf":{"timers":"timerVal"}}'
         self.assertEqual(actual, expected)
 
-    def test_retreive_multi_OrderedDict_from_list(self):
+    def test_retreive_multi_dict_from_list(self):
         v = VyattaJSONParser({}, {})
-        node = OrderedDict(
-            [('protocols', [OrderedDict([('ospf', OrderedDict([('timers', 'timerVal')]))])])])
+        node = {'protocols': [{'ospf': {'timers': 'timerVal'}}]}
         steps = ['protocols', DICT_ELEM_LABEL]
         actual = v.retrieve_value(node, steps)
         print(actual)
-        expected = "[{'ospf':{'timers':'timerVal'}}]"
+        expected = '[{"ospf":{"timers":"timerVal"}}]'
+        self.assertEqual(actual, expected)
+
+    def test_retreive_dict_members_separated(self):
+        v = VyattaJSONParser({}, {})
+        node = {'acl': {'tagnode': '1', 'rule': [{'any': None, 'host': 'a b'}]}}
+        steps = ['acl', DICT_ELEM_LABEL]
+        actual = v.retrieve_value(node, steps)
+        expected = '{"tagnode":"1"&"rule":[{"any":null&"host":"ab"}]}'
+        self.assertEqual(actual, expected)
+
+    def test_dict_value_with_comma_in_conditional(self):
+        node = {'protocols': {'bgp': [{'tagnode': '1', 'neighbor': [
+            {'tagnode': '10.0.0.1', 'description': 'uplink, primary', 'shutdown': None}]}]}}
+        syntax = {'/protocols/bgp/@element/neighbor/@element':
+                  "$if|neighbor {tagnode/@text} shutdown,|shutdown in {@dict}$"}
+        v = VyattaJSONParser(node, syntax)
+        actual = v.parse_config()
+        expected = ['neighbor 10.0.0.1 shutdown']
         self.assertEqual(actual, expected)
 
     def test_retrieve_value_traverse_down(self):
@@ -69,6 +89,14 @@ class ParserTestCase(unittest.TestCase):
         expected = "timerVal"
         self.assertEqual(actual, expected)
 
+    def test_retrieve_values_skips_missing(self):
+        v = VyattaJSONParser({}, {})
+        node = {'ospf': {'timers': "timerVal"}}
+        paths = ['/ospf/timers/@text', '/ospf/freq/@text', '/bgp/@dict']
+        actual = v.retrieve_values(node, paths)
+        expected = {'/ospf/timers/@text': "timerVal"}
+        self.assertEqual(actual, expected)
+
     def test_retrieve_value_traverse_up_simple(self):
         v = VyattaJSONParser({}, {})
         l3 = {'timers': "timerVal"}
@@ -81,6 +109,16 @@ class ParserTestCase(unittest.TestCase):
         expected = "value"
         self.assertEqual(actual, expected)
 
+    def test_retrieve_value_keeps_steps(self):
+        v = VyattaJSONParser({}, {})
+        l2 = {'timers': "timerVal"}
+        node = {'ospf': l2, 'key': 'value'}
+        v.parent_stack = [node]
+        steps = (DIR_TRAVERSE_UP_LABEL, 'key', TEXT_LEAF_LABEL)
+        self.assertEqual(v.retrieve_value(l2, steps), "value")
+        # the same steps can be used again
+        self.assertEqual(v.retrieve_value(l2, steps), "value")
+
     def test_retrieve_value_traverse_up_mixed(self):
         v = VyattaJSONParser({}, {})
         l4 = {'timers': "timerVal"}
@@ -95,12 +133,33 @@ class ParserTestCase(unittest.TestCase):
         expected = "value"
         self.assertEqual(actual, expected)
 
+    def test_read_syntax_files(self):
+        v = VyattaJSONParser({}, {})
+        v.read_syntax_files(os.path.join(
+            os.path.dirname(os.path.abspath(__file__)), 'configs', 'commands'))
+        self.assertIn('/protocols/bgp/@enter', v.syntax)
+        self.assertIn('/protocols/static/@enter', v.syntax)
+        for command in v.syntax['/protocols/bgp/@element']:
+            self.assertIsInstance(command, PreparsedCommand)
+
+    def test_execute_steps(self):
+        configs = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'configs')
+        node = {'protocols': {'ospf': {'parameters': {'router-id': '1.1.1.1'}}}}
+        v = VyattaJSONParser(node, {})
+        v.discover_syntax(os.path.join(configs, 'commands'))
+        v.load_steps(os.path.join(configs, 'steps.json'))
+        v.execute_steps()
+        for syntax_file in v.syntax_files.values():
+            self.assertTrue(syntax_file.processed)
+        self.assertEqual(v.output[0], 'log syslog')
+        self.assertIn('ospf router-id 1.1.1.1', v.output)
+
     def test_retrieve_command_as_list(self):
         template = "{/timers/@text} {/@text}"
         path = '/protocols/ospf/freq'
         syntax = {path: template}
         v = VyattaJSONParser({}, syntax)
-        actual = list(v.retrieve_commands(path))
+        actual = [commandf.command for commandf, _ in v.retrieve_commands(path)]
         expected = [template]
         self.assertEqual(actual, expected)
 
@@ -109,10 +168,30 @@ class ParserTestCase(unittest.TestCase):
         path = '/protocols/ospf/freq'
         syntax = {path: template}
         v = VyattaJSONParser({}, syntax)
-        actual = list(v.retrieve_commands(path))
+        actual = [commandf.command for commandf, _ in v.retrieve_commands(path)]
         expected = ["{{/{}/timers/@text}}".format(DIR_TRAVERSE_UP_LABEL)]
         self.assertEqual(actual, expected)
 
+    def test_retrieve_command_refs(self):
+        template = "{/../timers/@text} {/@text}"
+        path = '/protocols/ospf/freq'
+        syntax = {path: template}
+        v = VyattaJSONParser({}, syntax)
+        actual = [refs for _, refs in v.retrieve_commands(path)]
+        expected = [('/{}/timers/@text'.format(DIR_TRAVERSE_UP_LABEL), '/@text')]
+        self.assertEqual(actual, expected)
+        # parsed commands are reused
+        self.assertIs(v.retrieve_commands(path), v.retrieve_commands(path))
+
+    def test_retrieve_command_refs_unique(self):
+        template = "$if|as-set,|as-set in {/@dict}$ $if|med,|med in {/@dict}$"
+        path = '/protocols/bgp'
+        syntax = {path: template}
+        v = VyattaJSONParser({}, syntax)
+        actual = [refs for _, refs in v.retrieve_commands(path)]
+        expected = [('/@dict',)]
+        self.assertEqual(actual, expected)
+
     def test_traversal_up_primitive_same_value_children(self):
         l1 = {'keyN': "21", 'ospf': {'timers': "timerVal", "freq": "21"}}
         node = {'keyN': "21", 'protocols': l1, }
@@ -156,8 +235,7 @@ class ParserTestCase(unittest.TestCase):
         self.assertEqual(actual, expected)
 
     def test_priority_sorting(self):
-        node = OrderedDict({'ospf': OrderedDict(
-            {'timers': "timerVal", "freq": "21"})})
+        node = {'ospf': {'timers': "timerVal", "freq": "21"}}
         syntax = {'/ospf/freq': "{/@text}", '/ospf/timers': "{/@text}"}
         first = []
         # test timers moved at the end
@@ -171,13 +249,13 @@ class ParserTestCase(unittest.TestCase):
         # test timers moved at the front
         expected = ['timerVal', '21']
         first.append(last.pop())
+        v.output.clear()
         v.sort_tree(priorities)
         actual = v.parse_config()
         self.assertEqual(actual, expected)
 
     def test_priority_sorting_multiple_nonexisting(self):
-        node = OrderedDict(
-            {'key1': "1", 'key2': '2', 'key3': '3', 'key4': '4'})
+        node = {'key1': "1", 'key2': '2', 'key3': '3', 'key4': '4'}
         syntax = {'/key1': "{/@text}", '/key2': "{/@text}", '/key3': "{/@text}",
                   '/key4': "{/@text}"}
         first = ['key1', 'key2', 'keyN']
@@ -193,11 +271,76 @@ class ParserTestCase(unittest.TestCase):
         last.clear()
         first.extend(['key4', 'key1', 'keyZ'])
         last.extend(['key3', 'key2'])
+        v.output.clear()
         v.sort_tree(priorities)
         expected = ['4', '1', '3', '2']
         actual = v.parse_config()
         self.assertEqual(actual, expected)
 
+    def test_output_config(self):
+        v = VyattaJSONParser({}, {})
+        v.output.extend(['router ospf', ' network 10.0.0.0/8 area 0'])
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'frr.conf')
+            v.output_config(path, getpass.getuser())
+            with open(path) as f:
+                actual = f.read()
+            self.assertEqual(os.stat(path).st_mode & 0o777, 0o600)
+        expected = 'router ospf\n network 10.0.0.0/8 area 0\n!\n'
+        self.assertEqual(actual, expected)
+
+    def test_priority_sorting_no_output(self):
+        node = {'ospf': {'timers': "timerVal", "freq": "21"}}
+        syntax = {'/ospf/@exit': "exit", '/ospf/freq': "{/@text}"}
+        priorities = {'/ospf': {"first": ['timers']}}
+        v = VyattaJSONParser(node, syntax)
+        v.sort_tree(priorities)
+        self.assertEqual(v.output, [])
+
+    def test_output_file_mode(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'frr.conf')
+            fd = VyattaJSONParser._open_output_file(path)
+            try:
+                self.assertEqual(os.fstat(fd).st_mode & 0o777, 0o600)
+            finally:
+                os.close(fd)
+
+    def test_output_streamed(self):
+        node = {'ospf': {'timers': "timerVal", "freq": "21"}}
+        syntax = {'/ospf/timers': "timers {/@text}", '/ospf/freq': "freq {/@text}"}
+        v = VyattaJSONParser(node, syntax)
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'frr.conf')
+            v.open_output(path)
+            v.parse_config()
+            v.output_config(path, getpass.getuser())
+            with open(path) as f:
+                actual = f.read()
+            self.assertEqual(os.stat(path).st_mode & 0o777, 0o600)
+        expected = 'timers timerVal\nfreq 21\n!\n'
+        self.assertEqual(actual, expected)
+
+    def test_output_kept_on_failure(self):
+        node = {'ospf': {'timers': "timerVal", "freq": "abc"}}
+        syntax = {'/ospf/timers': "timers {/@text}", '/ospf/freq': "freq {/@text:d}"}
+        with tempfile.TemporaryDirectory() as tmp:
+            commands = os.path.join(tmp, 'commands')
+            os.mkdir(commands)
+            with open(os.path.join(commands, 'ospf.json'), 'w') as f:
+                json.dump(syntax, f)
+            path = os.path.join(tmp, 'frr.conf')
+            with open(path, 'w') as f:
+                f.write('router ospf\n!\n')
+            v = VyattaJSONParser(node, {})
+            v.discover_syntax(commands)
+            v.steps = [VyattaJSONParser.Step([], list(v.syntax_files.values()))]
+            self.assertRaises(ValueError, v.execute_steps, path)
+            with open(path) as f:
+                actual = f.read()
+            self.assertEqual(actual, 'router ospf\n!\n')
+            self.assertEqual(sorted(os.listdir(tmp)), ['commands', 'frr.conf'])
+
     def test_multiple_commands(self):
         l1 = [{'ospf': [{'timers': "timerVal", "freq": "21"}], 'keyl2': 'vall21'},
               {'keyl2': 'vall22'}]